@@ -25,7 +25,7 @@ processor = VideoProcessor(video_path, fit_path, offset_seconds, './output')
 from fitparse import FitFile
 fit = FitFile(fit_path)
 processor.records = list(fit.get_messages('record'))
-processor._extract_gps_data()
+processor._extract_all_data()
 
 # 获取视频信息
 result = subprocess.run(
@@ -43,8 +43,9 @@ print(f"较短边: {min(width, height)}")
 print(f"地图大小: {int(min(width, height) * 0.5)}")
 
 # 生成预览帧（使用偏移时间后的第一帧）
+processor._build_static_overlay(width, height)
 data = processor._get_data_at_offset(offset_seconds)
-overlay = processor._create_overlay(width, height, data)
+overlay = processor._compose_overlay(processor._create_overlay(data), width, height)
 
 # 保存预览图
 overlay.save('preview_overlay.png')
@@ -5,15 +5,78 @@
 """
 from fitparse import FitFile
 from PIL import Image, ImageDraw, ImageFont
+import numpy as np
 import subprocess
 import os
 import json
 import time
-import shutil
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import tempfile
+from collections import deque
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
 import multiprocessing
 
 
+# 帧生成子进程中的处理器实例，由 _init_worker 初始化
+_worker_processor = None
+
+# 帧生成进程数上限：相同画面只渲染一次，进程池大多空闲，更多进程只会多占内存
+_MAX_WORKERS = 8
+
+# 未写入ffmpeg的叠加帧（主进程在途结果与ffmpeg管道输入队列）各自的内存预算
+_FRAME_BUFFER_BYTES = 64 * 1024 * 1024
+
+
+def _available_cpus():
+    """当前进程可用的CPU核数（按CPU亲和性计算，不支持时退回总核数）"""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return multiprocessing.cpu_count()
+
+
+def _init_worker(state):
+    """子进程初始化：根据渲染状态重建处理器"""
+    global _worker_processor
+    processor = VideoProcessor.__new__(VideoProcessor)
+    processor.__dict__.update(state)
+    size, static_bg = state['_static_bg']
+    # 直接引用传入的字节而不再解码复制；静态图层只会被 copy()，不会被修改
+    processor._static_bg = Image.frombuffer('RGBA', size, static_bg, 'raw', 'RGBA', 0, 1)
+    processor._load_fonts()
+    _worker_processor = processor
+
+
+def _render_frame(data):
+    """在子进程中生成一帧叠加图层，返回原始RGBA字节"""
+    return _worker_processor._create_overlay(data).tobytes()
+
+
+@lru_cache(maxsize=None)
+def _get_fonts(font_size, font_size_small):
+    """
+    加载数据面板使用的粗体和细体字体
+    
+    按字号缓存，同一进程内处理多个视频（如Web服务连续处理任务）时不重复加载
+    """
+    try:
+        font_bold = ImageFont.truetype('/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf', font_size)
+        font_regular = ImageFont.truetype('/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf', font_size_small)
+    except:
+        try:
+            font_bold = ImageFont.truetype('/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf', font_size)
+            font_regular = font_bold
+        except:
+            font_bold = ImageFont.load_default()
+            font_regular = font_bold
+    return font_bold, font_regular
+
+
+def _parse_fraction(text):
+    """解析ffprobe输出的分数形式帧率（如 '30000/1001'）"""
+    numerator, _, denominator = text.partition('/')
+    return int(numerator) / int(denominator) if denominator else float(numerator)
+
+
 class VideoProcessor:
     """
     视频处理器
@@ -22,7 +85,7 @@ class VideoProcessor:
     - 解析FIT文件获取运动数据（心率、配速、步频、距离、功率）
     - 提取GPS轨迹数据
     - 生成数据叠加图层（数据面板、全局路线图、近距离小地图）
-    - 使用多线程加速帧生成
+    - 使用多进程加速帧生成
     - 使用GPU加速视频编码（如果可用）
     """
     def __init__(self, video_path, fit_path, offset_seconds, output_path, progress_callback=None):
@@ -56,204 +119,427 @@ class VideoProcessor:
         try:
             # 解析FIT数据
             self._update_progress(0, "解析FIT文件...")
-            fit = FitFile(self.fit_path)
-            self.records = list(fit.get_messages('record'))
-            
-            # 提取GPS坐标并预处理
-            self._extract_gps_data()
+            self._load_fit_data()
             
             # 获取视频信息
             self._update_progress(5, "获取视频信息...")
             width, height, fps, duration = self._get_video_info()
-            total_frames = int(duration * fps)
             
-            # 生成叠加图层
-            self._update_progress(10, f"生成叠加图层 (共{total_frames}帧)...")
-            overlay_dir = 'overlay_frames'
-            os.makedirs(overlay_dir, exist_ok=True)
+            # 预绘制静态图层
+            self._build_static_overlay(width, height)
             
-            start_time = time.time()
-            completed_frames = 0
+            with self._create_executor() as executor:
+                output_file = self._render_video(executor, fps, duration)
             
-            # 使用多线程生成帧
-            max_workers = min(multiprocessing.cpu_count(), 8)  # 最多8个线程
+            self._update_progress(100, "完成")
+            return output_file
             
-            def generate_frame(frame_num):
-                video_time = frame_num / fps
-                activity_time = self.offset_seconds + video_time
-                data = self._get_data_at_offset(activity_time)
-                overlay = self._create_overlay(width, height, data)
-                overlay.save(f'{overlay_dir}/frame_{frame_num:04d}.png')
-                return frame_num
+        except Exception as e:
+            self._update_progress(-1, f"错误: {str(e)}")
+            raise
+    
+    @classmethod
+    def process_batch(cls, video_paths, fit_path, offsets, output_path, progress_callback=None):
+        """
+        批量处理同一次运动的多个视频片段，返回输出文件路径列表
+        
+        FIT文件只解析一次；连续的同分辨率片段共用静态图层和帧生成进程池，
+        不必为每个片段重新初始化子进程
+        
+        参数：
+        - video_paths: 视频文件路径列表
+        - fit_path: FIT文件路径
+        - offsets: 每个视频相对于运动开始的偏移秒数，与 video_paths 一一对应
+        - output_path: 输出目录
+        """
+        if not video_paths:
+            raise ValueError("video_paths 不能为空")
+        if len(video_paths) != len(offsets):
+            raise ValueError("video_paths 与 offsets 数量不一致")
+        
+        clip_count = len(video_paths)
+        processor = cls(video_paths[0], fit_path, offsets[0], output_path)
+        
+        # 输出文件按视频文件名生成，重名（如不同相机的同名片段）会互相覆盖
+        output_names = [processor._output_file(video_path) for video_path in video_paths]
+        duplicates = sorted({name for name in output_names if output_names.count(name) > 1})
+        if duplicates:
+            raise ValueError(f"多个视频片段的输出文件重名: {', '.join(duplicates)}")
+        
+        def clip_progress(clip_num):
+            # 把单个片段的进度映射到整体进度
+            def update_progress(percent, message):
+                if progress_callback:
+                    overall = percent if percent < 0 else int((clip_num * 100 + percent) / clip_count)
+                    progress_callback(overall, f"[{clip_num + 1}/{clip_count}] {message}")
+            return update_progress
+        
+        executor = None
+        output_files = []
+        try:
+            processor.progress_callback = clip_progress(0)
+            processor._update_progress(0, "解析FIT文件...")
+            processor._load_fit_data()
             
-            with ThreadPoolExecutor(max_workers=max_workers) as executor:
-                futures = {executor.submit(generate_frame, i): i for i in range(total_frames)}
+            static_size = None
+            for clip_num, (video_path, offset_seconds) in enumerate(zip(video_paths, offsets)):
+                processor.video_path = video_path
+                processor.offset_seconds = offset_seconds
+                processor.progress_callback = clip_progress(clip_num)
                 
-                for future in as_completed(futures):
-                    completed_frames += 1
-                    if completed_frames % 10 == 0 or completed_frames == total_frames:
-                        progress = 10 + int(completed_frames / total_frames * 70)
-                        elapsed = time.time() - start_time
-                        eta = elapsed / completed_frames * (total_frames - completed_frames)
-                        self._update_progress(
-                            progress, 
-                            f"生成叠加图层: {completed_frames}/{total_frames} (剩余 {int(eta)}s, {max_workers}线程)"
-                        )
-            
-            # 合成视频
-            encoder_info = f" (GPU: {self.gpu_encoder})" if self.gpu_encoder else " (CPU)"
-            self._update_progress(80, f"合成视频{encoder_info}...")
-            output_file = os.path.join(self.output_path, os.path.basename(self.video_path).replace('.mp4', '_with_data.mp4'))
-            os.makedirs(self.output_path, exist_ok=True)
-            
-            # 构建FFmpeg命令
-            ffmpeg_cmd = ['ffmpeg', '-y']
+                processor._update_progress(5, "获取视频信息...")
+                width, height, fps, duration = processor._get_video_info()
+                
+                # 分辨率变化时才重新绘制静态图层并重建进程池
+                if (width, height) != static_size:
+                    if executor:
+                        executor.shutdown()
+                    processor._build_static_overlay(width, height)
+                    executor = processor._create_executor()
+                    static_size = (width, height)
+                
+                output_files.append(processor._render_video(executor, fps, duration))
             
-            # 添加硬件加速
-            if self.gpu_encoder == 'nvenc':
-                ffmpeg_cmd.extend(['-hwaccel', 'cuda'])
-            elif self.gpu_encoder == 'qsv':
-                ffmpeg_cmd.extend(['-hwaccel', 'qsv'])
-            elif self.gpu_encoder == 'vaapi':
-                ffmpeg_cmd.extend(['-hwaccel', 'vaapi'])
+            if progress_callback:
+                progress_callback(100, "完成")
+            return output_files
             
+        except Exception as e:
+            processor._update_progress(-1, f"错误: {str(e)}")
+            raise
+        finally:
+            if executor:
+                executor.shutdown()
+    
+    def _output_file(self, video_path):
+        """视频对应的输出文件路径"""
+        return os.path.join(self.output_path, os.path.basename(video_path).replace('.mp4', '_with_data.mp4'))
+    
+    def _load_fit_data(self):
+        """解析FIT文件并提取运动数据和GPS坐标"""
+        fit = FitFile(self.fit_path)
+        self.records = list(fit.get_messages('record'))
+        self._extract_all_data()
+    
+    def _create_executor(self):
+        """
+        创建帧生成进程池
+        
+        使用多进程生成帧（叠加层绘制受GIL限制，多线程无法充分并行）。
+        子进程只依赖FIT数据和静态图层，与视频路径和偏移时间无关，
+        因此同一分辨率的多个视频片段可以共用一个进程池
+        
+        子进程按需启动，可能晚于ffmpeg进程创建；使用spawn方式启动，
+        避免fork出的子进程继承ffmpeg的stdin管道导致ffmpeg收不到EOF
+        """
+        self._worker_count = min(_MAX_WORKERS, _available_cpus())
+        return ProcessPoolExecutor(max_workers=self._worker_count,
+                                   mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=_init_worker, initargs=(self._worker_state(),))
+    
+    def _render_video(self, executor, fps, duration, gpu_compose=True):
+        """
+        生成叠加图层并与视频合成，返回输出文件路径（需先调用 _build_static_overlay）
+        
+        NVIDIA/Intel编码时默认在GPU上合成；源视频无法硬件解码时（如4:2:2 10bit、
+        旧显卡上的AV1）GPU滤镜图会失败，此时改为CPU合成重新编码一次
+        """
+        gpu_compose = gpu_compose and self.gpu_encoder in ('nvenc', 'qsv')
+        total_frames = int(duration * fps)
+        
+        output_file = self._output_file(self.video_path)
+        os.makedirs(self.output_path, exist_ok=True)
+        
+        # 构建FFmpeg命令
+        ffmpeg_cmd = ['ffmpeg', '-y', '-v', 'error']
+        
+        # 添加硬件加速
+        # GPU合成：解码后的帧留在显存中，叠加层上传后在GPU上合成，直接送入编码器
+        if gpu_compose and self.gpu_encoder == 'nvenc':
             ffmpeg_cmd.extend([
-                '-i', self.video_path,
-                '-framerate', str(fps),
-                '-i', f'{overlay_dir}/frame_%04d.png',
-                '-filter_complex', '[0:v][1:v]overlay=0:0'
+                '-init_hw_device', 'cuda=hw', '-filter_hw_device', 'hw',
+                '-hwaccel', 'cuda', '-hwaccel_device', 'hw', '-hwaccel_output_format', 'cuda'
             ])
+        elif gpu_compose and self.gpu_encoder == 'qsv':
+            ffmpeg_cmd.extend([
+                '-init_hw_device', 'qsv=hw', '-filter_hw_device', 'hw',
+                '-hwaccel', 'qsv', '-hwaccel_device', 'hw', '-hwaccel_output_format', 'qsv'
+            ])
+        elif self.gpu_encoder == 'nvenc':
+            ffmpeg_cmd.extend(['-hwaccel', 'cuda'])
+        elif self.gpu_encoder == 'qsv':
+            ffmpeg_cmd.extend(['-hwaccel', 'qsv'])
+        elif self.gpu_encoder == 'vaapi':
+            ffmpeg_cmd.extend(['-hwaccel', 'vaapi'])
+        
+        # 叠加层图集以原始RGBA帧通过stdin输入，无需落盘PNG
+        # 源视频加大读取队列，避免读线程阻塞；管道里每个包都是一整帧未压缩图集，
+        # 队列按内存预算折算帧数，生产者总是快于编码器，过大的队列只会占满内存
+        # 管道格式已知，跳过探测
+        atlas_width, atlas_height = self._atlas_size
+        frame_bytes = atlas_width * atlas_height * 4
+        pipe_queue_size = max(8, min(1024, _FRAME_BUFFER_BYTES // frame_bytes))
+        ffmpeg_cmd.extend([
+            '-thread_queue_size', '1024',
+            '-fflags', '+genpts',
+            '-i', self.video_path,
+            '-thread_queue_size', str(pipe_queue_size),
+            '-probesize', '32',
+            '-analyzeduration', '0',
+            '-f', 'rawvideo',
+            '-pixel_format', 'rgba',
+            '-video_size', f'{atlas_width}x{atlas_height}',
+            '-framerate', str(fps),
+            '-i', '-',
+            '-filter_complex', self._tile_filter(gpu_compose)
+        ])
+        
+        # 选择编码器（均使用高吞吐量预设，叠加数据不需要慢速预设的压缩效率）
+        if self.gpu_encoder == 'nvenc':
+            ffmpeg_cmd.extend(['-c:v', 'h264_nvenc', '-preset', 'p1', '-tune', 'll', '-rc', 'vbr', '-cq', '28'])
+        elif self.gpu_encoder == 'qsv':
+            ffmpeg_cmd.extend(['-c:v', 'h264_qsv', '-preset', 'veryfast', '-global_quality', '28'])
+        elif self.gpu_encoder == 'vaapi':
+            ffmpeg_cmd.extend(['-c:v', 'h264_vaapi', '-qp', '28'])
+        elif self.gpu_encoder == 'amf':
+            ffmpeg_cmd.extend(['-c:v', 'h264_amf', '-quality', 'speed', '-qp_i', '28'])
+        else:
+            # 回退到CPU编码
+            # 帧生成进程池按核数开满，但相同画面只渲染一次，进程大多空闲；
+            # x264取一半核数（至少4线程），给进程池的渲染突发留出余量
+            x264_threads = max(4, _available_cpus() // 2)
+            ffmpeg_cmd.extend([
+                '-c:v', 'libx264', '-preset', 'ultrafast', '-tune', 'zerolatency', '-crf', '28',
+                '-threads', str(x264_threads), '-x264-params', 'sliced-threads=1:lookahead-threads=1'
+            ])
+        
+        ffmpeg_cmd.extend(['-c:a', 'copy', output_file])
+        
+        # 生成叠加图层并边生成边编码
+        encoder_info = f"GPU: {self.gpu_encoder}" if self.gpu_encoder else "CPU"
+        self._update_progress(10, f"生成叠加图层并合成视频 (共{total_frames}帧, {encoder_info})...")
+        # stderr写入临时文件而不是管道：写帧期间无人读取，管道写满会导致双方阻塞
+        stderr_file = tempfile.TemporaryFile()
+        ffmpeg_proc = subprocess.Popen(ffmpeg_cmd, stdin=subprocess.PIPE, stderr=stderr_file)
+        
+        start_time = time.time()
+        written_frames = 0
+        
+        # 同时在途的叠加层数上限：每个已完成的结果都是一整帧图集，按内存预算限制
+        max_pending = max(2, min(self._worker_count * 2, _FRAME_BUFFER_BYTES // frame_bytes))
+        pending = deque()
+        
+        def write_next_frames():
+            # 按帧号顺序取回结果，同一条记录的叠加层重复写入对应帧数
+            nonlocal written_frames
+            future, frame_count = pending.popleft()
+            frame_bytes = future.result()
+            for _ in range(frame_count):
+                ffmpeg_proc.stdin.write(frame_bytes)
+            reported = written_frames // 10
+            written_frames += frame_count
+            if written_frames // 10 > reported or written_frames == total_frames:
+                progress = 10 + int(written_frames / total_frames * 85)
+                elapsed = time.time() - start_time
+                eta = elapsed / written_frames * (total_frames - written_frames)
+                self._update_progress(
+                    progress,
+                    f"生成叠加图层: {written_frames}/{total_frames} (剩余 {int(eta)}s, {self._worker_count}进程)"
+                )
+        
+        with stderr_file:
+            try:
+                for idx, frame_count in self._group_frames_by_record(total_frames, fps):
+                    pending.append((executor.submit(_render_frame, self.data_by_idx[idx]), frame_count))
+                    if len(pending) >= max_pending:
+                        write_next_frames()
+                while pending:
+                    write_next_frames()
+            except BrokenPipeError:
+                # ffmpeg提前退出，错误信息在下面统一读取；尚未开始的渲染任务不再需要
+                for future, _ in pending:
+                    future.cancel()
+            except Exception:
+                for future, _ in pending:
+                    future.cancel()
+                ffmpeg_proc.kill()
+                ffmpeg_proc.wait()
+                raise
             
-            # 选择编码器
-            if self.gpu_encoder == 'nvenc':
-                ffmpeg_cmd.extend(['-c:v', 'h264_nvenc', '-preset', 'p4', '-cq', '28'])
-            elif self.gpu_encoder == 'qsv':
-                ffmpeg_cmd.extend(['-c:v', 'h264_qsv', '-preset', 'medium', '-global_quality', '28'])
-            elif self.gpu_encoder == 'vaapi':
-                ffmpeg_cmd.extend(['-c:v', 'h264_vaapi', '-qp', '28'])
-            elif self.gpu_encoder == 'amf':
-                ffmpeg_cmd.extend(['-c:v', 'h264_amf', '-quality', 'balanced', '-qp_i', '28'])
-            else:
-                # 回退到CPU编码
-                ffmpeg_cmd.extend(['-c:v', 'libx264', '-preset', 'medium', '-crf', '28'])
-            
-            ffmpeg_cmd.extend(['-c:a', 'copy', output_file])
-            
-            subprocess.run(ffmpeg_cmd, capture_output=True)
-            
-            # 清理临时文件
-            self._update_progress(95, "清理临时文件...")
-            shutil.rmtree(overlay_dir)
-            
-            self._update_progress(100, "完成")
-            return output_file
-            
-        except Exception as e:
-            self._update_progress(-1, f"错误: {str(e)}")
-            raise
+            ffmpeg_proc.communicate()
+            if ffmpeg_proc.returncode != 0:
+                stderr_file.seek(0)
+                stderr = stderr_file.read().decode(errors='replace').strip()
+                if not gpu_compose:
+                    raise RuntimeError(f"FFmpeg编码失败: {stderr}")
+        
+        if ffmpeg_proc.returncode != 0:
+            self._update_progress(10, "GPU合成失败，改用CPU合成...")
+            return self._render_video(executor, fps, duration, gpu_compose=False)
+        
+        return output_file
+    
+    def _group_frames_by_record(self, total_frames, fps):
+        """
+        把连续画面相同的视频帧分组，返回 [(记录序号, 帧数), ...]
+        
+        同一条FIT记录内的帧画面必然相同；相邻记录若显示的数据和地图状态
+        都没有变化（如GPS缺失时数据不变），也合并为一组只渲染一次
+        """
+        groups = []
+        prev_idx = -1
+        prev_key = None
+        for frame_num in range(total_frames):
+            video_time = frame_num / fps
+            activity_time = self.offset_seconds + video_time
+            idx = self._get_record_idx(activity_time)
+            if idx != prev_idx:
+                key = self._render_key(idx)
+                prev_idx = idx
+                if key != prev_key:
+                    groups.append([idx, 0])
+                    prev_key = key
+            groups[-1][1] += 1
+        return groups
+    
+    def _render_key(self, idx):
+        """决定叠加层画面的全部状态：面板文本、已走过的有效GPS点数、当前点是否有效"""
+        data = self.data_by_idx[idx]
+        done_count = self._done_count(idx)
+        return tuple(self._data_items(data)), done_count, bool(self.gps_valid[idx])
     
     def _get_video_info(self):
-        """获取视频信息"""
+        """获取视频信息（一次ffprobe同时读取视频流参数和时长）"""
         result = subprocess.run(
             ['ffprobe', '-v', 'quiet', '-print_format', 'json', 
-             '-show_entries', 'stream=width,height,r_frame_rate', self.video_path],
+             '-select_streams', 'v:0',
+             '-show_entries', 'stream=width,height,r_frame_rate:format=duration', self.video_path],
             capture_output=True, text=True
         )
         info = json.loads(result.stdout)
         video_stream = info['streams'][0]
         width = video_stream['width']
         height = video_stream['height']
-        fps = eval(video_stream['r_frame_rate'])
-        
-        result = subprocess.run(
-            ['ffprobe', '-v', 'quiet', '-print_format', 'json',
-             '-show_entries', 'format=duration', self.video_path],
-            capture_output=True, text=True
-        )
-        duration = float(json.loads(result.stdout)['format']['duration'])
+        fps = _parse_fraction(video_stream['r_frame_rate'])
+        duration = float(info['format']['duration'])
         
         return width, height, fps, duration
     
+    def _get_record_idx(self, offset_seconds):
+        """获取指定偏移时间对应的FIT记录序号（记录为1秒1条）"""
+        return min(int(offset_seconds), len(self.data_by_idx) - 1)
+    
     def _get_data_at_offset(self, offset_seconds):
         """获取指定偏移时间的运动数据"""
-        idx = min(int(offset_seconds), len(self.records) - 1)
-        record = self.records[idx]
-        
-        hr = record.get_value('heart_rate') or 0
-        speed = record.get_value('enhanced_speed') or record.get_value('speed') or 0
-        cadence = record.get_value('cadence') or 0
-        distance = (record.get_value('distance') or 0) / 1000
-        power = record.get_value('power') or 0
-        
-        if speed > 0:
-            pace_seconds = 1000 / speed
-            pace_min = int(pace_seconds // 60)
-            pace_sec = int(pace_seconds % 60)
-            pace_str = f"{pace_min}:{pace_sec:02d}"
-        else:
-            pace_str = "--:--"
-        
+        return self.data_by_idx[self._get_record_idx(offset_seconds)]
+    
+    def _compute_data(self, idx):
+        """从预提取的数组中取出单条FIT记录的运动数据"""
         return {
-            'hr': int(hr),
-            'pace': pace_str,
-            'cadence': int(cadence * 2) if cadence else 0,
-            'distance': distance,
-            'power': int(power),
+            'hr': int(self.hr[idx]),
+            'pace': self.pace_strs[idx],
+            'cadence': int(self.cadence[idx]),
+            'distance': float(self.distance_km[idx]),
+            'power': int(self.power[idx]),
             'current_idx': idx
         }
     
-    def _extract_gps_data(self):
-        """提取并预处理GPS数据"""
-        self.gps_coords = []
+    def _extract_all_data(self):
+        """
+        一次遍历FIT记录，把运动数据和GPS数据提取为numpy数组
+        
+        之后按记录序号直接索引，不再逐帧调用 record.get_value
+        """
+        fields = ('heart_rate', 'enhanced_speed', 'speed', 'cadence', 'distance', 'power',
+                  'position_lat', 'position_long')
+        values = {field: [] for field in fields}
         for record in self.records:
-            lat = record.get_value('position_lat')
-            lon = record.get_value('position_long')
-            if lat and lon:
-                # 转换semicircles到度
-                lat_deg = lat * (180 / 2**31)
-                lon_deg = lon * (180 / 2**31)
-                self.gps_coords.append((lat_deg, lon_deg))
-            else:
-                self.gps_coords.append(None)
+            for field in fields:
+                values[field].append(record.get_value(field))
+        
+        def column(field, missing=0):
+            return np.array([value or missing for value in values[field]], dtype=np.float64)
+        
+        # 运动数据
+        self.hr = column('heart_rate').astype(np.int16)
+        self.speed = np.array([enhanced or speed or 0 for enhanced, speed in zip(values['enhanced_speed'], values['speed'])],
+                              dtype=np.float64)
+        self.cadence = (column('cadence') * 2).astype(np.int16)  # 单脚步频换算为双脚
+        self.distance_km = column('distance') / 1000
+        self.power = column('power').astype(np.int32)
+        
+        # 配速文本表（每条记录一项）
+        pace_seconds = np.where(self.speed > 0, 1000 / np.maximum(self.speed, 1e-9), 0)
+        pace_min = (pace_seconds // 60).astype(int)
+        pace_sec = (pace_seconds % 60).astype(int)
+        self.pace_strs = [
+            f"{minutes}:{seconds:02d}" if seconds_total > 0 else "--:--"
+            for minutes, seconds, seconds_total in zip(pace_min.tolist(), pace_sec.tolist(), pace_seconds.tolist())
+        ]
+        
+        # 预先计算每条记录的运动数据，同一秒内的所有视频帧共用
+        self.data_by_idx = [self._compute_data(idx) for idx in range(len(self.records))]
+        
+        # GPS数据
+        lat = column('position_lat', np.nan)
+        lon = column('position_long', np.nan)
+        
+        # 转换semicircles到度
+        self.gps_valid = ~np.isnan(lat) & ~np.isnan(lon)
+        self.lat = lat * (180 / 2**31)
+        self.lon = lon * (180 / 2**31)
+        self.has_gps = bool(self.gps_valid.any())
+        
+        # 只保留有效点，后续按有效点序号绘制（无效点直接跳过，前后点相连）
+        self._valid_idx = np.flatnonzero(self.gps_valid)
+        self._valid_lat = self.lat[self._valid_idx]
+        self._valid_lon = self.lon[self._valid_idx]
+        self._route_pixel_cache = {}
         
         # 计算有效坐标的边界
-        valid_coords = [c for c in self.gps_coords if c is not None]
-        if valid_coords:
-            lats = [c[0] for c in valid_coords]
-            lons = [c[1] for c in valid_coords]
-            self.lat_min, self.lat_max = min(lats), max(lats)
-            self.lon_min, self.lon_max = min(lons), max(lons)
+        if self.has_gps:
+            self.lat_min, self.lat_max = self._valid_lat.min(), self._valid_lat.max()
+            self.lon_min, self.lon_max = self._valid_lon.min(), self._valid_lon.max()
             
             # 计算缩放比例（保持纵横比）
             lat_range = self.lat_max - self.lat_min
             lon_range = self.lon_max - self.lon_min
             self.coord_range = max(lat_range, lon_range)
-        else:
-            self.gps_coords = []
     
     def _gps_to_pixel(self, lat, lon, map_size, center_lat=None, center_lon=None, zoom_range=None):
-        """将GPS坐标转换为像素坐标"""
+        """将GPS坐标数组转换为像素坐标数组（int32）"""
         if zoom_range:
             # 小地图模式：以中心点为基准
             if center_lat is None or center_lon is None:
-                return map_size // 2, map_size // 2
-            x = int((lon - (center_lon - zoom_range)) / (zoom_range * 2) * (map_size - 20) + 10)
-            y = int(((center_lat + zoom_range) - lat) / (zoom_range * 2) * (map_size - 20) + 10)
+                return np.full(len(lat), map_size // 2, dtype=np.int32), np.full(len(lon), map_size // 2, dtype=np.int32)
+            x = ((lon - (center_lon - zoom_range)) / (zoom_range * 2) * (map_size - 20) + 10).astype(np.int32)
+            y = (((center_lat + zoom_range) - lat) / (zoom_range * 2) * (map_size - 20) + 10).astype(np.int32)
         else:
             # 全局地图模式
             if self.coord_range == 0:
-                return map_size // 2, map_size // 2
-            x = int((lon - self.lon_min) / self.coord_range * (map_size - 20) + 10)
-            y = int((self.lat_max - lat) / self.coord_range * (map_size - 20) + 10)
+                return np.full(len(lat), map_size // 2, dtype=np.int32), np.full(len(lon), map_size // 2, dtype=np.int32)
+            x = ((lon - self.lon_min) / self.coord_range * (map_size - 20) + 10).astype(np.int32)
+            y = ((self.lat_max - lat) / self.coord_range * (map_size - 20) + 10).astype(np.int32)
         return x, y
     
+    def _done_count(self, idx):
+        """截至第idx条记录（含）已走过的有效GPS点数，即已走路线在有效点列表中的前缀长度"""
+        return int(np.searchsorted(self._valid_idx, idx, side='right'))
+    
+    def _global_pixels(self, map_size):
+        """全局路线图上所有有效点的像素坐标，按地图大小缓存"""
+        if map_size not in self._route_pixel_cache:
+            self._route_pixel_cache[map_size] = self._gps_to_pixel(self._valid_lat, self._valid_lon, map_size)
+        return self._route_pixel_cache[map_size]
+    
     def _draw_mini_map(self, draw, current_idx, map_x, map_y, map_size):
         """绘制近距离小地图（右下角）"""
-        if not self.gps_coords or current_idx >= len(self.gps_coords):
+        if not self.has_gps or current_idx >= len(self.gps_valid):
             return
         
-        current_coord = self.gps_coords[current_idx]
-        if not current_coord:
+        if not self.gps_valid[current_idx]:
+            # 当前无GPS时不显示小地图，清除静态图层中预绘制的圆形背景
+            draw.rectangle([(map_x, map_y), (map_x + map_size, map_y + map_size)], fill=(0, 0, 0, 0))
             return
         
         # 使用绝对距离：前后100米
@@ -264,49 +550,29 @@ class VideoProcessor:
         zoom_range_lon = zoom_distance_meters / 85000   # 经度范围（北纬40度附近）
         zoom_range = max(zoom_range_lat, zoom_range_lon)  # 取较大值保证显示完整
         
-        # 绘制圆形背景（半透明黑色）
-        draw.ellipse(
-            [(map_x, map_y), (map_x + map_size, map_y + map_size)],
-            fill=(0, 0, 0, 120)
-        )
+        # 圆形背景（半透明黑色）已预绘制在静态图层中
         
         # 计算线条宽度
         line_width = max(2, int(map_size * 0.01))
         dot_size = max(6, int(map_size * 0.03))
         
         # 找出当前范围内的路线点
-        center_lat, center_lon = current_coord
-        
-        # 绘制路线（只绘制范围内的点）
-        prev_pixel = None
-        prev_in_circle = False
-        for i, coord in enumerate(self.gps_coords):
-            if coord:
-                lat, lon = coord
-                # 检查是否在显示范围内
-                if (abs(lat - center_lat) <= zoom_range and 
-                    abs(lon - center_lon) <= zoom_range):
-                    pixel = self._gps_to_pixel(lat, lon, map_size, center_lat, center_lon, zoom_range)
-                    pixel = (map_x + pixel[0], map_y + pixel[1])
-                    
-                    # 检查当前点是否在圆形区域内
-                    curr_in_circle = self._is_in_circle(pixel[0], pixel[1], map_x + map_size//2, map_y + map_size//2, map_size//2)
-                    
-                    # 只有当前点和前一个点都在圆内时才画线
-                    if curr_in_circle and prev_pixel and prev_in_circle:
-                        # 已走过的用灰白色，未走过的用白色
-                        color = (200, 200, 200, 255) if i <= current_idx else (255, 255, 255, 255)
-                        draw.line([prev_pixel, pixel], fill=color, width=line_width)
-                    
-                    if curr_in_circle:
-                        prev_pixel = pixel
-                        prev_in_circle = True
-                    else:
-                        prev_pixel = None
-                        prev_in_circle = False
-                else:
-                    prev_pixel = None
-                    prev_in_circle = False
+        center_lat, center_lon = self.lat[current_idx], self.lon[current_idx]
+        
+        visible_idx, px, py = self._project_mini_map(center_lat, center_lon, zoom_range, map_x, map_y, map_size)
+        
+        # 把连续可见的点切分成若干段，每段用一次polyline绘制
+        breaks = np.flatnonzero(np.diff(visible_idx) != 1) + 1
+        for start, end in zip(np.concatenate(([0], breaks)), np.concatenate((breaks, [len(visible_idx)]))):
+            if end - start < 2:
+                continue
+            points = list(zip(px[start:end], py[start:end]))
+            # 已走过的用灰白色，未走过的用白色（两段共用分界点）
+            done_count = int(np.searchsorted(self._valid_idx[visible_idx[start:end]], current_idx, side='right'))
+            if done_count >= 2:
+                draw.line(points[:done_count], fill=(200, 200, 200, 255), width=line_width, joint='curve')
+            if len(points) - done_count >= 1:
+                draw.line(points[max(done_count - 1, 0):], fill=(255, 255, 255, 255), width=line_width, joint='curve')
         
         # 绘制当前位置（中心的白色圆点）
         center_x = map_x + map_size // 2
@@ -324,44 +590,45 @@ class VideoProcessor:
             width=2
         )
     
+    def _project_mini_map(self, center_lat, center_lon, zoom_range, map_x, map_y, map_size):
+        """
+        一次性完成小地图的范围过滤、投影和圆形区域判断
+        
+        返回可见点在有效点中的序号，以及它们的像素坐标（Python int列表）
+        """
+        # 先按显示范围过滤，只投影范围内的点
+        in_range = np.flatnonzero((np.abs(self._valid_lat - center_lat) <= zoom_range) &
+                                  (np.abs(self._valid_lon - center_lon) <= zoom_range))
+        px, py = self._gps_to_pixel(self._valid_lat[in_range], self._valid_lon[in_range],
+                                    map_size, center_lat, center_lon, zoom_range)
+        px += map_x
+        py += map_y
+        
+        # 检查点是否在圆形区域内
+        in_circle = self._is_in_circle(px, py, map_x + map_size//2, map_y + map_size//2, map_size//2)
+        return in_range[in_circle], px[in_circle].tolist(), py[in_circle].tolist()
+    
     def _is_in_circle(self, x, y, center_x, center_y, radius):
         """判断点是否在圆内"""
         return (x - center_x) ** 2 + (y - center_y) ** 2 <= radius ** 2
     
     def _draw_route_map(self, draw, current_idx, map_x, map_y, map_size):
-        """绘制路线图"""
-        if not self.gps_coords:
+        """绘制路线图（完整路线已预绘制在静态图层中，这里只绘制已走路线和圆点）"""
+        if not self.has_gps:
             return
         
         # 计算线条宽度（根据地图大小）
-        line_width_gray = max(3, int(map_size * 0.008))  # 未走路线
         line_width_green = max(5, int(map_size * 0.012))  # 已走路线
         dot_size = max(12, int(map_size * 0.02))  # 圆点大小（更大）
         
-        # 绘制完整路线（白色）
-        prev_pixel = None
-        for coord in self.gps_coords:
-            if coord:
-                pixel = self._gps_to_pixel(coord[0], coord[1], map_size)
-                pixel = (map_x + pixel[0], map_y + pixel[1])
-                if prev_pixel:
-                    draw.line([prev_pixel, pixel], fill=(255, 255, 255, 255), width=line_width_gray)
-                prev_pixel = pixel
-        
         # 绘制已走过的路线（略灰的白色）
-        prev_pixel = None
-        for i, coord in enumerate(self.gps_coords[:current_idx + 1]):
-            if coord:
-                pixel = self._gps_to_pixel(coord[0], coord[1], map_size)
-                pixel = (map_x + pixel[0], map_y + pixel[1])
-                if prev_pixel:
-                    draw.line([prev_pixel, pixel], fill=(200, 200, 200, 255), width=line_width_green)
-                prev_pixel = pixel
-        
-        # 绘制起点（白色圆点）
-        if self.gps_coords[0]:
-            start_pixel = self._gps_to_pixel(self.gps_coords[0][0], self.gps_coords[0][1], map_size)
-            start_pixel = (map_x + start_pixel[0], map_y + start_pixel[1])
+        done_count = self._done_count(current_idx)
+        if done_count >= 2:
+            draw.line(self._route_pixels[:done_count], fill=(200, 200, 200, 255), width=line_width_green, joint='curve')
+        
+        # 绘制起点（白色圆点），需要盖在已走路线之上
+        if self.gps_valid[0]:
+            start_pixel = self._route_pixels[0]
             draw.ellipse(
                 [start_pixel[0] - dot_size, start_pixel[1] - dot_size, 
                  start_pixel[0] + dot_size, start_pixel[1] + dot_size],
@@ -369,79 +636,196 @@ class VideoProcessor:
             )
         
         # 绘制当前位置（白色圆点）
-        if current_idx < len(self.gps_coords) and self.gps_coords[current_idx]:
-            curr_coord = self.gps_coords[current_idx]
-            curr_pixel = self._gps_to_pixel(curr_coord[0], curr_coord[1], map_size)
-            curr_pixel = (map_x + curr_pixel[0], map_y + curr_pixel[1])
+        if current_idx < len(self.gps_valid) and self.gps_valid[current_idx]:
+            curr_pixel = self._route_pixels[done_count - 1]
             draw.ellipse(
                 [curr_pixel[0] - dot_size, curr_pixel[1] - dot_size, 
                  curr_pixel[0] + dot_size, curr_pixel[1] + dot_size],
                 fill=(255, 255, 255, 255)
             )
     
-    def _create_overlay(self, width, height, data):
-        """创建叠加图层"""
-        img = Image.new('RGBA', (width, height), (0, 0, 0, 0))
-        draw = ImageDraw.Draw(img)
+    def _build_static_overlay(self, width, height):
+        """
+        预计算与帧无关的内容：布局参数、字体和静态图层
         
+        叠加内容只占画面一小部分，因此不生成整幅画布，而是把数据面板、
+        路线图、小地图三个图块纵向排列在一张图集中，由ffmpeg裁剪后
+        分别叠加到各自位置。静态图层是图集的初始状态，包含完整路线（白色）
+        和小地图的半透明圆形背景，每帧只需复制后绘制动态部分
+        """
         # 根据视频尺寸计算比例
         base_size = min(width, height)
-        font_size = int(base_size * 0.05)  # 字体大小为短边的5%
-        font_size_small = int(base_size * 0.035)  # 小字体为短边的3.5%
+        self._font_size = int(base_size * 0.05)  # 字体大小为短边的5%
+        self._font_size_small = int(base_size * 0.035)  # 小字体为短边的3.5%
         
-        try:
-            font_bold = ImageFont.truetype('/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf', font_size)
-            font_regular = ImageFont.truetype('/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf', font_size_small)
-        except:
-            try:
-                font_bold = ImageFont.truetype('/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf', font_size)
-                font_regular = font_bold
-            except:
-                font_bold = ImageFont.load_default()
-                font_regular = font_bold
+        self._load_fonts()
         
         # 数据面板（左上角）- 无背景
         margin = int(base_size * 0.03)  # 边距为短边的3%
-        padding = int(base_size * 0.025)  # 内边距
+        self._padding = int(base_size * 0.025)  # 内边距
+        self._line_height = int(self._font_size * 1.3)
+        self._unit_offset = int(self._font_size * 0.15)  # 单位稍微下移对齐基线
         
-        panel_x, panel_y = margin, margin
+        # 图块列表：(画面x, 画面y, 宽, 高, 图集y)，宽高取偶数以便转换为yuv420
+        self._tiles = []
+        atlas_y = 0
         
-        y = panel_y + padding
-        line_height = int(font_size * 1.3)
+        # 面板宽度按各项数据的最大可能文本计算：位数取模板与本次数据中较多者，
+        # 避免低速时的长配速（如 "166:40"）等超出图块被裁掉
+        def widest(values, digits):
+            if len(values):
+                digits = max(digits, len(str(int(np.max(values)))))
+            return int('8' * digits)
         
-        # 绘制数据（数值用粗体，单位用细体小字）
-        data_items = [
+        pace_digits = max([4] + [len(pace) - 1 for pace in self.pace_strs])
+        panel_width = self._padding + max(
+            self._font_bold.getbbox(value_text)[2] + 5 + self._font_regular.getbbox(unit_text)[2]
+            for value_text, unit_text in self._data_items({
+                'hr': widest(self.hr, 3),
+                'pace': '8' * (pace_digits - 2) + ':88',
+                'cadence': widest(self.cadence, 3),
+                'distance': widest(self.distance_km, 3) + 0.88,
+                'power': widest(self.power, 4),
+            })
+        )
+        panel_width += panel_width % 2
+        panel_height = self._padding + self._line_height * 4 + int(self._font_size * 1.5)
+        panel_height += panel_height % 2
+        self._tiles.append((margin, margin, panel_width, panel_height, atlas_y))
+        # 以下坐标均为图集中的坐标
+        self._panel_x, self._panel_y = 0, atlas_y
+        atlas_y += panel_height
+        
+        if self.has_gps:
+            # 路线图（右上角）- 大小为短边的一半，四周留出圆点的空间
+            self._map_size = int(base_size * 0.5)
+            map_pad = max(12, int(self._map_size * 0.02))
+            map_tile_size = self._map_size + map_pad * 2 + 2
+            self._tiles.append((width - self._map_size - margin - map_pad, margin - map_pad,
+                                map_tile_size, map_tile_size, atlas_y))
+            self._map_x, self._map_y = map_pad, atlas_y + map_pad
+            atlas_y += map_tile_size
+            
+            # 小地图（右下角）- 大小为短边的30%
+            self._mini_map_size = int(base_size * 0.3)
+            mini_tile_size = self._mini_map_size + 1
+            mini_tile_size += mini_tile_size % 2
+            self._tiles.append((width - self._mini_map_size - margin, height - self._mini_map_size - margin,
+                                mini_tile_size, mini_tile_size, atlas_y))
+            self._mini_map_x, self._mini_map_y = 0, atlas_y
+            atlas_y += mini_tile_size
+        
+        self._atlas_size = (max(tile[2] for tile in self._tiles), atlas_y)
+        
+        img = Image.new('RGBA', self._atlas_size, (0, 0, 0, 0))
+        draw = ImageDraw.Draw(img)
+        
+        # 路线图上每个有效GPS点的像素坐标
+        self._route_pixels = []
+        if self.has_gps:
+            px, py = self._global_pixels(self._map_size)
+            self._route_pixels = list(zip((px + self._map_x).tolist(), (py + self._map_y).tolist()))
+        
+            # 绘制完整路线（白色）
+            line_width_gray = max(3, int(self._map_size * 0.008))  # 未走路线
+            if len(self._route_pixels) >= 2:
+                draw.line(self._route_pixels, fill=(255, 255, 255, 255), width=line_width_gray, joint='curve')
+            
+            # 绘制小地图圆形背景（半透明黑色）
+            draw.ellipse(
+                [(self._mini_map_x, self._mini_map_y),
+                 (self._mini_map_x + self._mini_map_size, self._mini_map_y + self._mini_map_size)],
+                fill=(0, 0, 0, 120)
+            )
+        
+        self._static_bg = img
+        return img
+    
+    def _tile_filter(self, gpu_compose=False):
+        """
+        生成把图集各图块裁剪并叠加到视频上的ffmpeg滤镜图（图集为第2路输入）
+        
+        GPU合成时视频帧在显存中，图块裁剪后上传，用 overlay_cuda/overlay_qsv 合成
+        """
+        filters = []
+        prev = '0:v'
+        if not gpu_compose:
+            upload, overlay = '', 'overlay'
+        elif self.gpu_encoder == 'nvenc':
+            # overlay_cuda 的带透明通道叠加要求主画面为yuv420p（CUDA解码输出为nv12）
+            filters.append('[0:v]scale_cuda=format=yuv420p[main]')
+            prev = 'main'
+            upload, overlay = ',format=yuva420p,hwupload', 'overlay_cuda'
+        else:
+            upload, overlay = ',format=bgra,hwupload=extra_hw_frames=64', 'overlay_qsv'
+        
+        count = len(self._tiles)
+        filters.append('[1:v]split=' + str(count) + ''.join(f'[t{i}]' for i in range(count)))
+        for i, (x, y, tile_width, tile_height, atlas_y) in enumerate(self._tiles):
+            filters.append(f'[t{i}]crop={tile_width}:{tile_height}:0:{atlas_y}{upload}[c{i}]')
+            out = f'[v{i}]' if i < count - 1 else ''
+            filters.append(f'[{prev}][c{i}]{overlay}=x={x}:y={y}{out}')
+            prev = f'v{i}'
+        return ';'.join(filters)
+    
+    def _compose_overlay(self, atlas, width, height):
+        """把图集按各图块位置合成为整幅叠加层（仅用于预览）"""
+        img = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+        for x, y, tile_width, tile_height, atlas_y in self._tiles:
+            tile = atlas.crop((0, atlas_y, tile_width, atlas_y + tile_height))
+            # 图块互不重叠，直接粘贴即可
+            img.paste(tile, (x, y))
+        return img
+    
+    def _load_fonts(self):
+        """按预计算的字号加载字体"""
+        self._font_bold, self._font_regular = _get_fonts(self._font_size, self._font_size_small)
+    
+    def _worker_state(self):
+        """
+        生成传给帧生成子进程的渲染状态
+        
+        不包含FIT记录、进度回调和字体对象（子进程中重新加载），
+        静态图层以原始字节传递
+        """
+        excluded = ('records', 'progress_callback', '_font_bold', '_font_regular', '_static_bg')
+        state = {key: value for key, value in self.__dict__.items() if key not in excluded}
+        state['_static_bg'] = (self._static_bg.size, self._static_bg.tobytes())
+        return state
+    
+    def _data_items(self, data):
+        """数据面板的各行文本：(数值, 单位)"""
+        return [
             (f"♥ {data['hr']}", "bpm"),
             (f"⚡ {data['pace']}", "/km"),
             (f"⟳ {data['cadence']}", "spm"),
             (f"⊙ {data['distance']:.2f}", "km"),
             (f"⚙ {data['power']}", "W")
         ]
+    
+    def _create_overlay(self, data):
+        """创建叠加图层图集（需先调用 _build_static_overlay）"""
+        img = self._static_bg.copy()
+        draw = ImageDraw.Draw(img)
+        
+        y = self._panel_y + self._padding
         
-        for value_text, unit_text in data_items:
-            x = panel_x + padding
+        # 绘制数据（数值用粗体，单位用细体小字）
+        for value_text, unit_text in self._data_items(data):
+            x = self._panel_x + self._padding
             # 绘制数值（粗体）
-            draw.text((x, y), value_text, fill=(255, 255, 255, 255), font=font_bold)
+            draw.text((x, y), value_text, fill=(255, 255, 255, 255), font=self._font_bold)
             # 计算数值文本宽度
-            value_bbox = draw.textbbox((x, y), value_text, font=font_bold)
+            value_bbox = draw.textbbox((x, y), value_text, font=self._font_bold)
             value_width = value_bbox[2] - value_bbox[0]
             # 绘制单位（细体小字，稍微偏下对齐）
-            unit_y = y + int(font_size * 0.15)  # 稍微下移对齐基线
-            draw.text((x + value_width + 5, unit_y), unit_text, fill=(255, 255, 255, 200), font=font_regular)
-            y += line_height
-        
-        # 路线图（右上角）- 大小为短边的一半
-        if self.gps_coords:
-            map_size = int(base_size * 0.5)
-            map_x = width - map_size - margin
-            map_y = margin
-            self._draw_route_map(draw, data['current_idx'], map_x, map_y, map_size)
-            
-            # 小地图（右下角）- 大小为短边的30%
-            mini_map_size = int(base_size * 0.3)
-            mini_map_x = width - mini_map_size - margin
-            mini_map_y = height - mini_map_size - margin
-            self._draw_mini_map(draw, data['current_idx'], mini_map_x, mini_map_y, mini_map_size)
+            unit_y = y + self._unit_offset
+            draw.text((x + value_width + 5, unit_y), unit_text, fill=(255, 255, 255, 200), font=self._font_regular)
+            y += self._line_height
+        
+        if self.has_gps:
+            self._draw_route_map(draw, data['current_idx'], self._map_x, self._map_y, self._map_size)
+            self._draw_mini_map(draw, data['current_idx'], self._mini_map_x, self._mini_map_y, self._mini_map_size)
         
         return img
     